@@ -1,14 +1,25 @@
+import asyncio
+import bisect
+import functools
 import json
+import mmap
 import os
 import subprocess # To call Node.js script for proof generation
 import time
-from fastapi import FastAPI, HTTPException
-from merkletools import MerkleTools
+from fastapi import FastAPI, HTTPException, Request, Response
 import hashlib
 from pathlib import Path
 import sys
 import logging
 
+from merkle import MerkleTree, empty_subtree_hashes
+
+# orjson is optional; fall back to the stdlib json module when it isn't installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # --- Logging Setup ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -19,14 +30,15 @@ app = FastAPI(title="Demo ASP Service", description="Simulates an ASP generating
 # Determine project base directory relative to this file's location
 # Assumes main.py is in asp-service/
 BASE_DIR = Path(__file__).resolve().parent.parent
-CIRCUIT_DIR = BASE_DIR / "circuits" / "attestation"
-ZK_OUT_DIR = BASE_DIR / "zk-out"
 MOCK_OFAC_FILE = Path(__file__).resolve().parent / "mock_ofac.json"
 NODE_PATH = "node" # Assumes 'node' is in the system PATH
 GENERATE_PROOF_SCRIPT = BASE_DIR / "scripts" / "generate_proof.js"
 CIRCUIT_NAME = "attestation" # Name of the circuit (without extension)
 TREE_LEVELS = 4 # Must match the 'levels' parameter in the Circom template
 TREE_SIZE = 2**TREE_LEVELS # Expected number of leaves (16 for levels=4)
+# Known bad address (must be in the mock list); its leaf hash is a public circuit input.
+# Ensure it is formatted consistently with the list (e.g., checksummed if needed)
+BAD_ADDRESS_IN_LIST = "0xBadAddress10000000000000000000000000000000"
 
 # --- State (In-memory for this demonstration) ---
 # Stores the latest generated attestation data
@@ -37,13 +49,85 @@ current_commitment = {
     "publicSignals": None   # Public signals used for the proof (decimal strings)
 }
 merkle_tree = None          # The MerkleTree object
-exclusion_set_hashes = []   # List of leaf hashes in the tree (hex strings)
+exclusion_set_hashes = []   # List of leaf hashes in the tree (raw 32-byte digests)
+# Pre-serialized /latest-attestation response, rebuilt only when the attestation changes
+latest_attestation_body = None  # JSON body (bytes)
+latest_attestation_etag = None  # Quoted ETag derived from the body
+# Circuit input for the last proven root; the path and leaf don't change unless the root does
+cached_circuit_input = None
+cached_circuit_input_root = None # Raw root bytes the cached input was built for
+# Raw root bytes current_commitment's proof was generated for. The prover reduces public
+# signals mod the BN254 field prime, so the returned publicSignals can't be compared to our inputs.
+proven_root = None
+# Serializes refreshes so concurrent /refresh calls don't interleave updates to the state above.
+# Created lazily (see get_refresh_lock) so it binds to the server's event loop.
+refresh_lock = None
 
 # --- Helper Functions ---
 
-def calculate_leaf_hash(address: str) -> str:
-    """Calculates the SHA3-256 hash of an address string."""
-    return hashlib.sha3_256(address.encode('utf-8')).hexdigest()
+def json_dumps(obj) -> bytes:
+    """Serializes obj to compact UTF-8 JSON bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+def json_loads(data: bytes):
+    """Parses JSON bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def calculate_leaf_hash(address: str) -> bytes:
+    """Calculates the SHA3-256 hash of an address string (raw digest bytes)."""
+    return hashlib.sha3_256(address.encode('utf-8')).digest()
+
+def load_json_file(path: Path):
+    """
+    Parses a JSON file. With orjson the file is memory-mapped and parsed in
+    place, avoiding a separate read() copy of large lists.
+    """
+    with open(path, 'rb') as f:
+        # mmap can't map an empty file; let the parser report it as invalid JSON
+        if orjson is None or os.fstat(f.fileno()).st_size == 0:
+            return json_loads(f.read())
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            return orjson.loads(view)
+
+def hash_encoded_leaves(encoded: list[bytes]) -> list[bytes]:
+    """Hashes a batch of UTF-8 encoded addresses to raw SHA3-256 digests."""
+    return [hashlib.sha3_256(b).digest() for b in encoded]
+
+def hash_to_decimal(node_hash: bytes) -> str:
+    """Converts a raw hash (leaf or tree node) into the decimal-string form expected by the circuit."""
+    return str(int.from_bytes(node_hash, 'big'))
+
+# The known bad address is fixed, so its hash and circuit input are computed once at import
+BAD_LEAF_HASH = calculate_leaf_hash(BAD_ADDRESS_IN_LIST)
+BAD_LEAF_HASH_DECIMAL_STR = hash_to_decimal(BAD_LEAF_HASH)
+
+# Define a consistent padding value (as raw digest)
+PADDING_HASH = calculate_leaf_hash("__DEFAULT_PADDING_LEAF__") # Use a distinct padding value
+# Roots of all-padding subtrees per level, so tree builds can skip hashing them
+EMPTY_SUBTREE_HASHES = empty_subtree_hashes(PADDING_HASH, TREE_LEVELS)
+
+def get_refresh_lock() -> asyncio.Lock:
+    """Returns the refresh lock, creating it on first use inside the running event loop."""
+    global refresh_lock
+    if refresh_lock is None:
+        refresh_lock = asyncio.Lock()
+    return refresh_lock
+
+def cache_latest_attestation():
+    """Serializes current_commitment once so /latest-attestation can serve it without re-encoding."""
+    global latest_attestation_body, latest_attestation_etag
+    # Note: publicSignals are returned as decimal strings as expected by the contract interaction script
+    latest_attestation_body = json_dumps({
+        "root": current_commitment["root"], # Hex root
+        "timestamp": current_commitment["timestamp"],
+        "proof": current_commitment["proof"], # Full proof object
+        "publicSignals": current_commitment["publicSignals"] # Decimal signals ["root", "badLeaf"]
+    })
+    latest_attestation_etag = f'"{hashlib.sha256(latest_attestation_body).hexdigest()[:16]}"'
 
 def load_exclusion_set():
     """Loads addresses from the mock file, calculates hashes, pads, sorts, and builds the Merkle tree."""
@@ -56,37 +140,49 @@ def load_exclusion_set():
             exclusion_set_hashes = []
             return
 
-        with open(MOCK_OFAC_FILE, 'r') as f:
-            addresses = json.load(f)
+        addresses = load_json_file(MOCK_OFAC_FILE)
+
+        # Only the first TREE_SIZE addresses fit in the tree; don't hash the rest
+        if len(addresses) > TREE_SIZE:
+            logging.warning(f"Exclusion list has more items ({len(addresses)}) than tree size ({TREE_SIZE}). Truncating.")
+            addresses = addresses[:TREE_SIZE]
 
         # Calculate hashes for all addresses
-        raw_hashes = [calculate_leaf_hash(addr) for addr in addresses]
+        raw_hashes = hash_encoded_leaves([addr.encode('utf-8') for addr in addresses])
         logging.info(f"Loaded {len(raw_hashes)} addresses, calculated hashes.")
 
-        # Define a consistent padding value (as hex hash)
-        padding_value = b"__DEFAULT_PADDING_LEAF__" # Use a distinct padding value
-        padding_hash = calculate_leaf_hash(padding_value.decode())
-
         # Pad the list with the padding hash to reach the exact TREE_SIZE
         num_to_pad = TREE_SIZE - len(raw_hashes)
-        if num_to_pad < 0:
-            logging.warning(f"Exclusion list has more items ({len(raw_hashes)}) than tree size ({TREE_SIZE}). Truncating.")
-            padded_hashes = raw_hashes[:TREE_SIZE]
-        elif num_to_pad > 0:
+        if num_to_pad > 0:
             logging.info(f"Padding list with {num_to_pad} default hashes.")
-            padded_hashes = raw_hashes + [padding_hash] * num_to_pad
+            padded_hashes = raw_hashes + [PADDING_HASH] * num_to_pad
         else:
             padded_hashes = raw_hashes
 
-        # Sort the final list of hashes (important for consistency if order matters)
-        exclusion_set_hashes = sorted(padded_hashes)
-        logging.info(f"Final leaf hash list size: {len(exclusion_set_hashes)}")
+        # Sort the final list of hashes (important for consistency if order matters).
+        # Raw bytes sort in the same order as their hex encodings.
+        new_hashes = sorted(padded_hashes)
+        logging.info(f"Final leaf hash list size: {len(new_hashes)}")
+
+        # Find which leaves differ from the tree built on the previous load (if any)
+        changed_indices = None
+        if merkle_tree is not None and merkle_tree.leaf_count == len(new_hashes):
+            changed_indices = [i for i, (old, new) in enumerate(zip(exclusion_set_hashes, new_hashes)) if old != new]
+
+        # Patching costs about one hash per level per changed leaf; fall back to a
+        # full rebuild when that would not be cheaper
+        if changed_indices is not None and len(changed_indices) * merkle_tree.depth < merkle_tree.leaf_count:
+            merkle_tree.update_leaves(changed_indices, [new_hashes[i] for i in changed_indices])
+            exclusion_set_hashes = new_hashes
+            logging.info(f"Merkle tree updated in place ({len(changed_indices)} changed leaves). Root: {merkle_tree.root.hex()}")
+        else:
+            exclusion_set_hashes = new_hashes
 
-        # Build the Merkle tree using the py-merkle-trees library
-        merkle_tree = MerkleTree(exclusion_set_hashes, sha256)
-        logging.info(f"Merkle tree built successfully. Root: {merkle_tree.root.hex() if merkle_tree else 'N/A'}")
+            # Build the Merkle tree (SHA-256 interior nodes, see merkle.py)
+            merkle_tree = MerkleTree(exclusion_set_hashes, EMPTY_SUBTREE_HASHES)
+            logging.info(f"Merkle tree built successfully. Root: {merkle_tree.root.hex() if merkle_tree else 'N/A'}")
 
-    except json.JSONDecodeError:
+    except json.JSONDecodeError: # orjson.JSONDecodeError is a subclass
         logging.error(f"Error decoding JSON from {MOCK_OFAC_FILE}")
         merkle_tree = None
         exclusion_set_hashes = []
@@ -95,9 +191,17 @@ def load_exclusion_set():
         merkle_tree = None
         exclusion_set_hashes = []
 
-def generate_attestation_proof():
-    """Generates the ZK proof for the current Merkle tree state."""
-    global current_commitment
+async def generate_attestation_proof(force: bool = False):
+    """
+    Generates the ZK proof for the current Merkle tree state.
+    SnarkJS runs in an executor thread, so the event loop keeps serving
+    other requests while the prover works.
+
+    If the root matches the one the current proof was generated for, the
+    existing proof still verifies (the bad leaf never changes), so only its
+    timestamp is refreshed unless `force` is set.
+    """
+    global current_commitment, cached_circuit_input, cached_circuit_input_root, proven_root
     if not merkle_tree or not exclusion_set_hashes:
         logging.error("Merkle tree or exclusion set not initialized. Cannot generate proof.")
         return
@@ -105,98 +209,95 @@ def generate_attestation_proof():
     logging.info("Generating ZK attestation proof...")
     try:
         # --- Prepare inputs for the ZK circuit ---
-        root_hex = merkle_tree.root.hex()
-        root_decimal_str = str(int(root_hex, 16))
+        root = merkle_tree.root
+        root_hex = root.hex() # Hex form is only needed for the API response and logs
         timestamp = int(time.time())
 
-        # Define known bad address (must be in the mock list) and a safe address (not in the list)
-        # Ensure these addresses are formatted consistently (e.g., checksummed if needed)
-        bad_address_in_list = "0xBadAddress10000000000000000000000000000000"
-        safe_address = "0xSafeAddress00000000000000000000000000000000" # Example safe address
-
-        bad_leaf_hash_hex = calculate_leaf_hash(bad_address_in_list)
-        bad_leaf_hash_decimal_str = str(int(bad_leaf_hash_hex, 16))
-        safe_leaf_hash_hex = calculate_leaf_hash(safe_address) # Hash of the safe address
-
-        # Find a leaf *in the tree* that is NOT the bad_leaf_hash to generate a valid path for.
-        # The circuit proves knowledge of *a* path, and that the leaf for that path isn't the bad one.
-        leaf_to_prove_hex = None
-        for h in exclusion_set_hashes:
-            if h != bad_leaf_hash_hex:
-                leaf_to_prove_hex = h
-                break # Found a suitable leaf
-
-        if leaf_to_prove_hex is None:
-            logging.error("Critical Error: Could not find a leaf in the tree different from the known bad leaf. Check padding/list.")
+        if root == cached_circuit_input_root and cached_circuit_input is not None:
+            # Same tree as last time: the chosen leaf and its path are unchanged
+            circuit_input = cached_circuit_input
+            logging.info("Merkle root unchanged, reusing cached circuit input.")
+        else:
+            # Find a leaf *in the tree* that is NOT the bad leaf hash to generate a valid path for.
+            # The circuit proves knowledge of *a* path, and that the leaf for that path isn't the bad one.
+            # The list is sorted, so if the first entry is the bad leaf (possibly listed more than once),
+            # the first different leaf is right after its run of duplicates.
+            leaf_index = 0 if exclusion_set_hashes[0] != BAD_LEAF_HASH else bisect.bisect_right(exclusion_set_hashes, BAD_LEAF_HASH)
+
+            if leaf_index >= len(exclusion_set_hashes):
+                logging.error("Critical Error: Could not find a leaf in the tree different from the known bad leaf. Check padding/list.")
+                return
+
+            root_decimal_str = hash_to_decimal(root)
+            leaf_to_prove = exclusion_set_hashes[leaf_index]
+            leaf_to_prove_decimal_str = hash_to_decimal(leaf_to_prove)
+
+            # Get the Merkle proof for the chosen leaf_to_prove
+            logging.info(f"Generating Merkle proof for leaf: {leaf_to_prove.hex()}")
+            proof_data = merkle_tree.get_proof(leaf_index)
+            logging.info(f"Merkle proof generated. Path length: {len(proof_data['path'])}")
+
+            # Prepare the input object for the Circom circuit
+            circuit_input = {
+                "root": root_decimal_str,
+                "knownBadLeafHash": BAD_LEAF_HASH_DECIMAL_STR,
+                "leaf": leaf_to_prove_decimal_str,
+                "pathElements": [hash_to_decimal(el) for el in proof_data['path']], # Path nodes are raw bytes
+                "pathIndices": [str(idx) for idx in proof_data['pathIndices']]
+            }
+            cached_circuit_input = circuit_input
+            cached_circuit_input_root = root
+
+        # Skip the prover entirely when the existing proof was already generated for this root
+        if not force and current_commitment["proof"] and root == proven_root:
+            current_commitment["timestamp"] = timestamp
+            cache_latest_attestation()
+            logging.info(f"Merkle root unchanged, reusing existing proof. Root: {root_hex}, Timestamp: {timestamp}")
             return
 
-        leaf_to_prove_decimal_str = str(int(leaf_to_prove_hex, 16))
-
-        # Get the Merkle proof for the chosen leaf_to_prove
-        logging.info(f"Generating Merkle proof for leaf: {leaf_to_prove_hex}")
-        proof_data = merkle_tree.get_proof_for_leaf(leaf_to_prove_hex, index=True)
-        logging.info(f"Merkle proof generated. Path length: {len(proof_data['path'])}")
-
-        # Prepare the input object for the Circom circuit
-        circuit_input = {
-            "root": root_decimal_str,
-            "knownBadLeafHash": bad_leaf_hash_decimal_str,
-            "leaf": leaf_to_prove_decimal_str,
-            "pathElements": [str(int(el.hex(), 16)) for el in proof_data['path']],
-            "pathIndices": [str(idx) for idx in proof_data['pathIndices']]
-        }
-
-        # Define paths for temporary and output files
-        input_json_path = CIRCUIT_DIR / "input.json" # Overwrite previous input
-        proof_json_path = ZK_OUT_DIR / "proof.json"
-        public_json_path = ZK_OUT_DIR / "public.json"
-
-        # Save input.json
-        with open(input_json_path, 'w') as f:
-            json.dump(circuit_input, f, indent=2)
-        logging.info(f"Saved circuit input to {input_json_path}")
-
         # --- Call SnarkJS via helper Node.js script ---
-        ZK_OUT_DIR.mkdir(exist_ok=True) # Ensure output directory exists
-
-        # Construct the command to run the Node.js helper script
+        # The input is piped over stdin and the result comes back on stdout,
+        # so nothing is written to or read back from disk.
         cmd = [
             NODE_PATH, str(GENERATE_PROOF_SCRIPT.resolve()),
             str(BASE_DIR.resolve()), # Argument 1: Base project directory
-            CIRCUIT_NAME,            # Argument 2: Name of the circuit
-            str(input_json_path.resolve()), # Argument 3: Path to input.json
-            str(proof_json_path.resolve()), # Argument 4: Path for output proof.json
-            str(public_json_path.resolve()) # Argument 5: Path for output public.json
+            CIRCUIT_NAME             # Argument 2: Name of the circuit
         ]
         logging.info(f"Running SnarkJS command: {' '.join(cmd)}")
 
-        # Execute the command
+        # Execute the command in a worker thread so it doesn't block the event loop.
+        # (asyncio subprocesses aren't supported by the Selector loop uvicorn uses on Windows.)
         # Run from BASE_DIR to ensure relative paths in scripts work correctly
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True, cwd=BASE_DIR)
-
-        logging.info(f"SnarkJS stdout:\n{result.stdout}")
-        if result.stderr:
-            logging.warning(f"SnarkJS stderr:\n{result.stderr}")
-
-        # Load the generated proof and public signals from the output files
-        with open(proof_json_path, 'r') as f:
-            proof = json.load(f)
-        with open(public_json_path, 'r') as f:
-            # Public signals are expected to be ["root_decimal", "bad_leaf_hash_decimal"]
-            public_signals = json.load(f)
+        result = await asyncio.get_running_loop().run_in_executor(None, functools.partial(
+            subprocess.run, cmd, input=json_dumps(circuit_input), capture_output=True, check=True, cwd=BASE_DIR
+        ))
+        # Output stays as raw bytes; it is only decoded if something is going to log it
+        stdout, stderr = result.stdout, result.stderr
+
+        # The helper reports progress on stderr; stdout carries only the result (parsed as bytes)
+        if stderr and logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f"SnarkJS output:\n{stderr.decode('utf-8', errors='replace')}")
+
+        # Parse the generated proof and public signals
+        output = json_loads(stdout)
+        proof = output["proof"]
+        # Public signals are expected to be ["root_decimal", "bad_leaf_hash_decimal"]
+        public_signals = output["publicSignals"]
 
         # Update the global state with the new attestation data
         current_commitment["root"] = root_hex # Store the hex root for the API response
         current_commitment["timestamp"] = timestamp
         current_commitment["proof"] = proof
         current_commitment["publicSignals"] = public_signals # Store decimal signals for contract submission
+        proven_root = root
+        cache_latest_attestation()
 
         logging.info(f"Successfully generated new ZK attestation. Root: {root_hex}, Timestamp: {timestamp}")
 
     except subprocess.CalledProcessError as e:
          logging.error(f"Error running SnarkJS command: {e}")
-         logging.error(f"SnarkJS stdout:\n{e.stdout}")
-         logging.error(f"SnarkJS stderr:\n{e.stderr}")
+         logging.error(f"SnarkJS stdout:\n{e.stdout.decode('utf-8', errors='replace')}")
+         logging.error(f"SnarkJS stderr:\n{e.stderr.decode('utf-8', errors='replace')}")
     except FileNotFoundError:
          logging.error(f"Error: '{NODE_PATH}' command not found. Is Node.js installed and in PATH?")
     except Exception as e:
@@ -209,47 +310,54 @@ def generate_attestation_proof():
 async def startup_event():
     """Initializes the exclusion set and generates the first proof when the server starts."""
     logging.info("ASP Service starting up...")
-    load_exclusion_set()
-    if merkle_tree:
-        generate_attestation_proof()
-    else:
-        logging.warning("Startup complete, but Merkle tree could not be initialized.")
+    async with get_refresh_lock():
+        # Tree building is CPU-bound; keep it off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, load_exclusion_set)
+        if merkle_tree:
+            await generate_attestation_proof()
+        else:
+            logging.warning("Startup complete, but Merkle tree could not be initialized.")
 
 @app.post("/refresh", summary="Refresh Exclusion Set and Generate New Proof")
-async def refresh_attestation():
+async def refresh_attestation(force: bool = False):
     """
     Endpoint to manually trigger reloading the exclusion list from the source
     (mock_ofac.json in this demo) and generating a new ZK attestation proof.
+    If the root is unchanged the existing proof is reused; pass `force=true`
+    to re-run the prover anyway.
     """
     logging.info("Received request to refresh exclusion set and proof...")
-    load_exclusion_set()
-    if merkle_tree:
-        generate_attestation_proof() # This updates the global current_commitment
-        if current_commitment["proof"]:
-             return {"message": "Attestation refreshed successfully", "commitment": current_commitment}
+    async with get_refresh_lock():
+        # Tree building is CPU-bound; keep it off the event loop so reads stay responsive
+        await asyncio.get_running_loop().run_in_executor(None, load_exclusion_set)
+        if merkle_tree:
+            await generate_attestation_proof(force=force) # This updates the global current_commitment
+            if current_commitment["proof"]:
+                 return {"message": "Attestation refreshed successfully", "commitment": current_commitment}
+            else:
+                 raise HTTPException(status_code=500, detail="Failed to generate proof after refresh.")
         else:
-             raise HTTPException(status_code=500, detail="Failed to generate proof after refresh.")
-    else:
-        raise HTTPException(status_code=500, detail="Failed to load exclusion set during refresh.")
+            raise HTTPException(status_code=500, detail="Failed to load exclusion set during refresh.")
 
 @app.get("/latest-attestation", summary="Get Latest Valid Attestation")
-async def get_latest_attestation():
+async def get_latest_attestation(request: Request):
     """
     Returns the latest generated commitment details, including the Merkle root (hex),
     timestamp, the ZK proof object, and the public signals (decimal strings)
     required for on-chain verification.
+
+    The body is serialized once per new attestation and served with an ETag;
+    clients sending a matching If-None-Match get a 304 with no body.
     """
-    if not current_commitment["root"] or not current_commitment["proof"]:
+    if not current_commitment["root"] or not current_commitment["proof"] or latest_attestation_body is None:
         logging.warning("Request for latest attestation failed: No valid attestation available.")
         raise HTTPException(status_code=404, detail="No valid attestation available yet. Try refreshing.")
-    # Return the currently stored commitment data
-    # Note: publicSignals are returned as decimal strings as expected by the contract interaction script
-    return {
-         "root": current_commitment["root"], # Hex root
-         "timestamp": current_commitment["timestamp"],
-         "proof": current_commitment["proof"], # Full proof object
-         "publicSignals": current_commitment["publicSignals"] # Decimal signals ["root", "badLeaf"]
-     }
+    # If-None-Match uses weak comparison (RFC 9110), so a W/ prefix on a client's tag still matches
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or latest_attestation_etag in [t.strip().removeprefix("W/") for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers={"ETag": latest_attestation_etag})
+    # Return the pre-serialized commitment data
+    return Response(content=latest_attestation_body, media_type="application/json", headers={"ETag": latest_attestation_etag})
 
 # --- Run Server Command ---
 # To run locally: uvicorn main:app --reload --port 8000 --app-dir asp-service
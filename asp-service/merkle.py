@@ -0,0 +1,151 @@
+"""
+Minimal binary Merkle tree used by the ASP service.
+
+Interior nodes are SHA-256(left || right) over two 32-byte children, so every
+node hash is a fixed 64-byte input. Hashing goes through hashlib, which is
+backed by OpenSSL and uses the SHA-NI / SIMD code paths when the CPU has them.
+
+Each tree level is stored as one contiguous buffer of 32-byte nodes, and a
+whole level is hashed in a single pass (hash_layer) rather than node by node.
+The buffers are mutable so a few changed leaves can be patched in place
+(update_leaves) by re-hashing only their paths to the root.
+
+Sparse trees are mostly padding, and any subtree made only of padding has a
+fixed root per level. Given that table (empty_subtree_hashes), construction
+copies those roots instead of hashing all-padding pairs.
+"""
+import hashlib
+
+# Bound once at import so the hot path skips the module attribute lookup
+_sha256 = hashlib.sha256
+
+NODE_SIZE = 32 # Size in bytes of every leaf and interior node
+PAIR_SIZE = 2 * NODE_SIZE # Size in bytes of one interior-node hash input
+
+def hash_pair(left: bytes, right: bytes) -> bytes:
+    """Hashes two 32-byte child nodes into their parent node."""
+    return _sha256(left + right).digest()
+
+def empty_subtree_hashes(empty_leaf: bytes, levels: int) -> list[bytes]:
+    """
+    Returns the roots of all-padding subtrees for heights 0..levels:
+    result[0] is `empty_leaf` and result[l] = hash_pair(result[l-1], result[l-1]).
+    """
+    hashes = [empty_leaf]
+    for _ in range(levels):
+        hashes.append(hash_pair(hashes[-1], hashes[-1]))
+    return hashes
+
+def hash_layer(data: bytes, n_pairs: int, empty_pair: bytes = None, empty_parent: bytes = None) -> bytes:
+    """
+    Hashes `n_pairs` consecutive 64-byte blocks of `data` (sibling pairs laid
+    out back to back) and returns the parent nodes as one contiguous buffer.
+
+    If `empty_pair` is given, blocks equal to it are not hashed; `empty_parent`
+    (their known hash) is emitted instead.
+    """
+    if len(data) < n_pairs * PAIR_SIZE:
+        raise ValueError(f"Buffer of {len(data)} bytes is too short for {n_pairs} pairs")
+    view = memoryview(data)
+    if empty_pair is None:
+        return b''.join([_sha256(view[i:i + PAIR_SIZE]).digest() for i in range(0, n_pairs * PAIR_SIZE, PAIR_SIZE)])
+    return b''.join([
+        empty_parent if view[i:i + PAIR_SIZE] == empty_pair else _sha256(view[i:i + PAIR_SIZE]).digest()
+        for i in range(0, n_pairs * PAIR_SIZE, PAIR_SIZE)
+    ])
+
+def build_merkle(leaves: list[bytes], empty_hashes: list[bytes] = None) -> tuple[bytes, list[bytearray]]:
+    """
+    Builds every level of the tree bottom-up, one hash_layer call per level.
+
+    `empty_hashes` is an optional table from empty_subtree_hashes(); pairs of
+    all-padding subtrees are then filled in from it rather than hashed.
+
+    Returns `(root, levels)` where levels[0] holds the leaves and levels[-1]
+    the root, each as a contiguous buffer of 32-byte nodes.
+    """
+    if not leaves or len(leaves) & (len(leaves) - 1):
+        raise ValueError(f"Leaf count must be a non-zero power of two, got {len(leaves)}")
+    if any(len(leaf) != NODE_SIZE for leaf in leaves):
+        raise ValueError(f"Every leaf must be exactly {NODE_SIZE} bytes")
+
+    levels = [bytearray(b''.join(leaves))]
+    level = levels[0]
+    while len(level) > NODE_SIZE:
+        height = len(levels) - 1
+        if empty_hashes is not None and height + 1 < len(empty_hashes):
+            empty_pair = empty_hashes[height] * 2
+            level = bytearray(hash_layer(level, len(level) // PAIR_SIZE, empty_pair, empty_hashes[height + 1]))
+        else:
+            level = bytearray(hash_layer(level, len(level) // PAIR_SIZE))
+        levels.append(level)
+    return bytes(levels[-1]), levels
+
+class MerkleTree:
+    """
+    Binary Merkle tree over a power-of-two number of 32-byte leaves.
+
+    All levels are kept in memory as contiguous node buffers (levels[0] are
+    the leaves, levels[-1] holds only the root), so proofs are read off
+    without re-hashing anything and leaf updates only touch their paths.
+    """
+
+    def __init__(self, leaves: list[bytes], empty_hashes: list[bytes] = None):
+        _, self.levels = build_merkle(leaves, empty_hashes)
+        self.leaf_count = len(leaves)
+
+    @property
+    def root(self) -> bytes:
+        return bytes(self.levels[-1])
+
+    @property
+    def depth(self) -> int:
+        return len(self.levels) - 1
+
+    def get_proof(self, leaf_index: int) -> dict:
+        """
+        Returns the Merkle path for the leaf at `leaf_index`.
+
+        `path` holds the sibling node at each level (leaf level first) and
+        `pathIndices` holds 0 when the running node is the left child and 1
+        when it is the right child, matching the circuit's MerkleProof inputs.
+        """
+        if not 0 <= leaf_index < self.leaf_count:
+            raise IndexError(f"Leaf index {leaf_index} out of range")
+
+        path = []
+        path_indices = []
+        index = leaf_index
+        for level in self.levels[:-1]:
+            sibling = (index ^ 1) * NODE_SIZE
+            path.append(bytes(level[sibling:sibling + NODE_SIZE]))
+            path_indices.append(index & 1)
+            index >>= 1
+        return {"path": path, "pathIndices": path_indices}
+
+    def update_leaves(self, leaf_indices: list[int], new_leaves: list[bytes]):
+        """
+        Replaces the leaves at `leaf_indices` with `new_leaves` and re-hashes
+        only the nodes on their paths to the root: O(k log N) hashes for k
+        changed leaves instead of O(N) for a full rebuild.
+        """
+        if len(leaf_indices) != len(new_leaves):
+            raise ValueError("leaf_indices and new_leaves must have the same length")
+
+        leaf_level = self.levels[0]
+        dirty = set()
+        for index, leaf in zip(leaf_indices, new_leaves):
+            if not 0 <= index < self.leaf_count:
+                raise IndexError(f"Leaf index {index} out of range")
+            if len(leaf) != NODE_SIZE:
+                raise ValueError(f"Every leaf must be exactly {NODE_SIZE} bytes")
+            leaf_level[index * NODE_SIZE:(index + 1) * NODE_SIZE] = leaf
+            dirty.add(index >> 1)
+
+        # Walk up one level at a time; siblings that changed together share a parent
+        # and are only hashed once
+        for child_level, parent_level in zip(self.levels, self.levels[1:]):
+            for parent in dirty:
+                start = parent * PAIR_SIZE
+                parent_level[parent * NODE_SIZE:(parent + 1) * NODE_SIZE] = _sha256(child_level[start:start + PAIR_SIZE]).digest()
+            dirty = {parent >> 1 for parent in dirty}
\ No newline at end of file
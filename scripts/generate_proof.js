@@ -1,5 +1,14 @@
 // Helper script to generate proofs using SnarkJS
 // This script is designed to be called from the Python ASP service.
+//
+// Two modes are supported:
+//   * Pipe mode (used by the ASP service):
+//       node generate_proof.js <base_dir> <circuit_name>
+//     Reads the circuit input JSON from stdin and writes
+//     {"proof": ..., "publicSignals": ...} to stdout. Progress messages go to stderr
+//     so stdout carries only the result.
+//   * File mode (handy for manual runs):
+//       node generate_proof.js <base_dir> <circuit_name> <input_json_path> <proof_json_path> <public_json_path>
 const snarkjs = require("snarkjs");
 const fs = require("fs");
 const path = require("path");
@@ -13,11 +22,15 @@ const logger = null; // Set to null to disable snarkjs logging for cleaner outpu
 async function run() {
     // --- Argument Parsing ---
     const args = process.argv.slice(2);
-    if (args.length !== 5) {
-        console.error("❌ Usage: node generate_proof.js <base_dir> <circuit_name> <input_json_path> <proof_json_path> <public_json_path>");
+    if (args.length !== 2 && args.length !== 5) {
+        console.error("❌ Usage: node generate_proof.js <base_dir> <circuit_name> [<input_json_path> <proof_json_path> <public_json_path>]");
+        console.error("   Without the file paths, input is read from stdin and the result is written to stdout.");
         process.exit(1);
     }
     const [baseDir, circuitName, inputJsonPath, proofJsonPath, publicJsonPath] = args;
+    const pipeMode = args.length === 2;
+    // In pipe mode stdout is reserved for the result, so progress goes to stderr
+    const log = pipeMode ? console.error : console.log;
 
     // --- Path Construction ---
     // Construct paths relative to the base directory provided as an argument
@@ -25,39 +38,44 @@ async function run() {
     const zkeyPath = path.join(baseDir, "zk-out", `${circuitName}_final.zkey`);
 
     // --- Pre-checks ---
-    console.log(`\nGenerating proof for circuit: ${circuitName}`);
-    console.log(` -> WASM path: ${wasmPath}`);
-    console.log(` -> ZKey path: ${zkeyPath}`);
-    console.log(` -> Input path: ${inputJsonPath}`);
+    log(`\nGenerating proof for circuit: ${circuitName}`);
+    log(` -> WASM path: ${wasmPath}`);
+    log(` -> ZKey path: ${zkeyPath}`);
+    log(` -> Input: ${pipeMode ? "<stdin>" : inputJsonPath}`);
     if (!fs.existsSync(wasmPath)) { console.error("❌ Error: WASM file not found!"); process.exit(1); }
     if (!fs.existsSync(zkeyPath)) { console.error("❌ Error: Final ZKey file not found! Run setup first."); process.exit(1); }
-    if (!fs.existsSync(inputJsonPath)) { console.error("❌ Error: Input JSON file not found!"); process.exit(1); }
+    if (!pipeMode && !fs.existsSync(inputJsonPath)) { console.error("❌ Error: Input JSON file not found!"); process.exit(1); }
 
     // --- Proof Generation ---
     try {
-        // Read the input data generated by the ASP service
-        const inputData = JSON.parse(fs.readFileSync(inputJsonPath, "utf8"));
-        console.log("   Read input data successfully.");
+        // Read the input data generated by the ASP service (fd 0 is stdin)
+        const inputData = JSON.parse(fs.readFileSync(pipeMode ? 0 : inputJsonPath, "utf8"));
+        log("   Read input data successfully.");
 
         // Generate the proof and public signals using snarkjs.groth16.fullProve
-        console.log("   Generating Groth16 proof with SnarkJS...");
+        log("   Generating Groth16 proof with SnarkJS...");
         const { proof, publicSignals } = await snarkjs.groth16.fullProve(
             inputData,
             wasmPath,
             zkeyPath,
             logger // Pass logger (or null)
         );
-        console.log("   ✅ Proof generated successfully.");
+        log("   ✅ Proof generated successfully.");
+        log("   (Public signals represent the public inputs: [root, knownBadLeafHash] in decimal format)");
 
         // --- Output ---
-        // Save the generated proof object to the specified JSON file
-        fs.writeFileSync(proofJsonPath, JSON.stringify(proof, null, 2));
-        // Save the generated public signals array to the specified JSON file
-        fs.writeFileSync(publicJsonPath, JSON.stringify(publicSignals, null, 2));
+        if (pipeMode) {
+            // Hand both results back to the caller in a single JSON object
+            process.stdout.write(JSON.stringify({ proof, publicSignals }));
+        } else {
+            // Save the generated proof object to the specified JSON file
+            fs.writeFileSync(proofJsonPath, JSON.stringify(proof, null, 2));
+            // Save the generated public signals array to the specified JSON file
+            fs.writeFileSync(publicJsonPath, JSON.stringify(publicSignals, null, 2));
 
-        console.log(`   -> Proof saved to: ${proofJsonPath}`);
-        console.log(`   -> Public signals saved to: ${publicJsonPath}`);
-        console.log("   (Public signals represent the public inputs: [root, knownBadLeafHash] in decimal format)");
+            log(`   -> Proof saved to: ${proofJsonPath}`);
+            log(`   -> Public signals saved to: ${publicJsonPath}`);
+        }
 
     } catch (err) {
         console.error("❌ Error during proof generation:", err);